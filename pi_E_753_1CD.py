@@ -1,47 +1,93 @@
 import time
+import numpy as np
 import serial
 
+# (identity, unit, z_min, z_max) per port -> skip queries on reconnect:
+_IDENTITY_CACHE = {}
+
 class Controller:
     '''
     Basic device adaptor for PI E-753.1CD, high-speed, single-axis, digital
     piezo controller. Many more commands are available and have not been
     implemented.
     '''
+    # pre-encoded commands (sent often -> no formatting or encoding per call):
+    _CMD_SVO_ON         = b'SVO 1 1'
+    _CMD_SVO_OFF        = b'SVO 1 0'
+    _CMD_ANALOG_ON      = b'SPA 1 0x06000500 2'
+    _CMD_ANALOG_OFF     = b'SPA 1 0x06000500 0'
+    _CMD_LEVEL_ADVANCED = b'CCL 1 advanced'
+    _CMD_POS            = b'POS?'
+    _CMD_TMN            = b'TMN?'
+    _CMD_TMX            = b'TMX?'
+    _CMD_TSP_2          = b'TSP? 2'
+
     def __init__(self,
                  which_port,            # COM port for controller
                  z_tol_um=0.25,         # tolerance on positional error (um)
                  name='E-753.1CD',      # optional name
                  verbose=True,          # False for max speed
-                 very_verbose=False):   # True for debug
+                 very_verbose=False,    # True for debug
+                 low_latency=True,      # request low latency serial driver
+                 fast_init=True,        # batch init queries in 1 write
+                 baudrate=115200,       # must match controller setting
+                 slew_um_per_s=None):   # measured speed (um/s) for polling
         self.z_tol_um = z_tol_um
+        self.slew_um_per_s = slew_um_per_s
         self.name = name
         self.verbose = verbose
         self.very_verbose = very_verbose
         if self.verbose: print('%s: Opening...'%name, end='')
         try:
             self.port = serial.Serial(
-                port=which_port, baudrate=115200, timeout=5)
+                port=which_port, baudrate=baudrate, timeout=5)
         except serial.serialutil.SerialException:
             raise IOError('%s: No connection on port %s'%(name, which_port))
+        # ~16ms -> ~1ms read latency on USB-serial adaptors (Linux only). The
+        # Windows pyserial driver has no 'set_low_latency_mode' -> no-op, so
+        # on Windows set the adaptor 'Latency Timer' to 1ms instead (e.g. FTDI:
+        # Device Manager -> Port Settings -> Advanced -> Latency Timer):
+        if low_latency:
+            try:
+                self.port.set_low_latency_mode(True)
+            except (IOError, ValueError, NotImplementedError, AttributeError):
+                pass # not supported by this driver/platform
         if self.verbose: print(" done.")
-        # check for errors and get device identity:
-        self._check_errors()
-        self.identity = self._send('*IDN?')[0]
-        # get physical units:
-        self.port.write(b'SPA? 1 0x07000601\n')
-        self.unit =self.port.readline(
-            ).rstrip().decode('latin-1').split('=')[1]
+        # get device identity, units, position limits and position:
+        self._z_dirty = True # self.z unknown -> query controller
+        if which_port in _IDENTITY_CACHE: # (once per port)
+            (self.identity, self.unit,
+             self.z_min, self.z_max) = _IDENTITY_CACHE[which_port]
+            self.get_position(verbose=False) # 'POS?' + 'ERR?' in 1 write
+        elif fast_init: # 1 write and 1 read for all queries + error check
+            self.port.write(b'*IDN?\nSPA? 1 0x07000601\n'
+                            b'TMN?\nTMX?\nPOS?\nERR?\n')
+            replies = self._read_replies(num_replies=6)
+            self.identity = replies[0][0]
+            self.unit = replies[1][0].rsplit('=', 1)[1]
+            self.z_min = self._parse_eq_float(replies[2][0])
+            self.z_max = self._parse_eq_float(replies[3][0])
+            self.z = self._parse_eq_float(replies[4][0])
+            self._check_errors(error=replies[5][0])
+        else:
+            self._check_errors()
+            self.identity = self._send('*IDN?')[0]
+            self.port.write(b'SPA? 1 0x07000601\n')
+            self.unit = self.port.readline(
+                ).rsplit(b'=', 1)[1].rstrip().decode('latin-1')
+            self.z_min = self._parse_eq_float(self._send(self._CMD_TMN)[0])
+            self.z_max = self._parse_eq_float(self._send(self._CMD_TMX)[0])
+            self.get_position(verbose=False)
         assert self.unit == 'µM'
-        # get position and position limits:
-        self.get_position(verbose=False)
-        self.z_min = float(self._send('TMN?')[0].split('=')[1])
-        self.z_max = float(self._send('TMX?')[0].split('=')[1])
+        _IDENTITY_CACHE[which_port] = ( # only cache validated devices
+            self.identity, self.unit, self.z_min, self.z_max)
         # set state:
         self._moving = False
         self._analog_control = False
         self._set_analogue_control_limits = False
-        self._send('CCL 1 advanced', respond=False) # need >= 'cmd level 1'
-        self._send('SPA 1 0x06000500 0', respond=False) # disable analog        
+        self._last_ai_z = None # z for the last voltage from get_voltage...()
+        self._send(self._CMD_LEVEL_ADVANCED, respond=False) # >= 'cmd level 1'
+        self._send(self._CMD_ANALOG_OFF, respond=False) # disable analog
         self._set_servo_enable(True) # closed loop control mandatory for 'MOV'
         # move z to legal position if needed:
         if self.z <= self.z_min + self.z_tol_um:
@@ -63,35 +109,62 @@ class Controller:
         print("%s:  = %10.06f, %10.06f (um)"%(
             self.name, self.z_min, self.z_max))
 
-    def _send(self, cmd, respond=True):
+    def _send(self, cmd, respond=True, check=True):
         if self.very_verbose:
             print("%s: sending cmd = "%self.name, cmd)
-        cmd = bytes(cmd, encoding='ascii')
-        self.port.write(cmd + b'\n')
+        if isinstance(cmd, str): # bytes (e.g. pre-encoded) are sent as is
+            cmd = cmd.encode('ascii')
+        if check: # append 'ERR?' -> 1 write and 1 read for cmd + error check
+            self.port.write(cmd + b'\nERR?\n')
+        else:
+            self.port.write(cmd + b'\n')
+        replies = self._read_replies(num_replies=int(respond) + int(check))
         if respond:
-            responses = []
-            while True:
-                response = self.port.readline()
-                assert response.endswith(b'\n') # default terminator
-                responses.append(response.rstrip().decode('ascii')) # strip ' '
-                if len(response) == 1: break # = 1 for self._reboot()
-                if response[-2] != 32: break # ASCII #32 = space -> not finished
+            responses = replies[0]
         else:
             responses = None
-        if self.very_verbose:
+        if self.very_verbose: # leftover bytes = protocol error -> debug only
             print("%s:  response   = "%self.name, responses)
-        assert self.port.in_waiting == 0
-        self._check_errors()
+            assert self.port.in_waiting == 0
+        if check:
+            self._check_errors(error=replies[-1][0])
         return responses
 
-    def _check_errors(self):
-        self.port.write(b'ERR?\n')  # Get Error Number -> check with manual
-        self.error = self.port.readline()
-        if self.error != b'0\n':    # 0 = no error
+    def _read_replies(self, num_replies=1):
+        # read all waiting bytes in bulk (readline() reads 1 byte per call):
+        data = bytearray()
+        while num_replies > 0:
+            chunk = self.port.read(self.port.in_waiting or 1)
+            if len(chunk) == 0:
+                raise IOError('%s: timeout waiting for reply'%self.name)
+            data.extend(chunk)
+            # finished replies = lines not continued (ASCII #32 = space):
+            if data.endswith(b'\n'): # default terminator
+                if data.count(b'\n') - data.count(b' \n') >= num_replies:
+                    break
+        # split the joined buffer once (empty line counts, e.g. for reboot):
+        replies, responses = [], []
+        for response in data.decode('latin-1').split('\n')[:-1]: # e.g. 'µ'
+            responses.append(response.rstrip()) # strip ' '
+            if not response.endswith(' '):
+                replies.append(responses)
+                responses = []
+        return replies
+
+    def _check_errors(self, error=None):
+        if error is None:
+            self.port.write(b'ERR?\n') # Get Error Number -> check with manual
+            error = self._read_replies()[0][0]
+        self.error = error
+        if self.error != '0':       # 0 = no error
             raise RuntimeError(
-                "%s: error = "%self.name, self.error.decode("ascii"))
+                "%s: error = "%self.name, self.error)
         return None
 
+    @staticmethod
+    def _parse_eq_float(response): # e.g. '1=50.000000' -> 50.0
+        return float(response[response.index('=') + 1:])
+
     def _get_cmd_list(self):
         if self.verbose:
             print("%s: getting list of available commands"%self.name)
@@ -132,50 +205,114 @@ class Controller:
 
     def _set_servo_enable(self, enable):
         if enable:
-            self._send('SVO 1 1', respond=False)
+            self._send(self._CMD_SVO_ON, respond=False)
         if not enable:
-            self._send('SVO 1 0', respond=False)
+            self._send(self._CMD_SVO_OFF, respond=False)
+            self._z_dirty = True # z can drift in open loop
         if self.very_verbose:
             print("%s: servo enabled = %s"%(self.name, enable))
         return None
 
+    def _start_move_timer(self, distance_um):
+        # 'slew_um_per_s' is not a datasheet value (piezo move time is mostly
+        # settling) -> measure for your stage/load, else no sleep before poll
+        self._move_start = time.perf_counter()
+        self._move_eta_s = 0
+        if self.slew_um_per_s is not None:
+            self._move_eta_s = distance_um / self.slew_um_per_s
+        return None
+
+    def _wait_on_target(self):
+        # wait for the expected move time, then poll (less USB traffic). Only
+        # sleep if > 20ms left since Windows (Python < 3.11) rounds sleep() up
+        # to a ~15.6ms tick -> wake up ~1 tick early so we never over sleep:
+        t_left_s = self._move_eta_s - (time.perf_counter() - self._move_start)
+        if t_left_s > 0.02:
+            time.sleep(t_left_s - 0.016)
+        t_deadline_s = time.perf_counter() + 5 # wall clock limit for polling
+        timeout_s, self.port.timeout = self.port.timeout, 0.01 # short reads
+        try: # (short blocking read, no sleep() -> ~15.6ms tick on Windows)
+            while True:
+                self.port.write(b'\x05') # Request Motion Status
+                response = self.port.read(2)
+                while len(response) < 2:
+                    if time.perf_counter() > t_deadline_s: break
+                    response += self.port.read(2 - len(response))
+                if response == b'0\n': break
+                if time.perf_counter() > t_deadline_s:
+                    self.port.reset_input_buffer() # drop late status bytes
+                    raise TimeoutError(
+                        '%s: timeout waiting for on target'%self.name)
+        finally:
+            self.port.timeout = timeout_s
+        return None
+
     def _finish_moving(self):
         if not self._moving:
             return None
-        while True:
-            self.port.write(b'\x05') # Request Motion Status
-            response = self.port.read(2)
-            if response == b'0\n': break
+        self._wait_on_target()
         self._moving = False
         if self.verbose: print('%s:  -> finished moving'%self.name)
         self._check_errors()
+        self._z_dirty = False # on target -> self.z is known
         return None
 
-    def get_position(self, verbose=True):
+    def get_position(self, verbose=True, cached=False):
         if verbose: print("%s: position (z)"%self.name)
-        self.z = float(self._send('POS?')[0].split('=')[1])
+        # 'cached=True' -> skip 'POS?' when on target after a finished move
+        # and return self.z = commanded target (not measured z):
+        if not cached or self._z_dirty:
+            self.z = self._parse_eq_float(self._send(self._CMD_POS)[0])
         if verbose: print("%s:  = %10.06f (um)"%(self.name, self.z))
         return self.z
 
     def move_um(self, z, relative=True, block=True):
         self._finish_moving()
         assert not self._analog_control
+        z_old = self.z
         if relative:
             self.z = float(self.z + z)
-            cmd = 'MOV 1 %0.9f'%self.z
+            cmd = b'MOV 1 %0.9f'%self.z
         if not relative: # Abolute move
             self.z= float(z)
-            cmd = 'MOV 1 %0.9f'%self.z
+            cmd = b'MOV 1 %0.9f'%self.z
         assert self.z_min <= self.z <= self.z_max
         if self.verbose:
             print("%s: moving to (z)"%self.name)
             print("%s:  = %10.06f (um)"%(self.name, self.z))
         self._send(cmd, respond=False)
+        self._start_move_timer(abs(self.z - z_old))
         self._moving = True
+        self._z_dirty = True # moving -> query controller until finished
         if block:
             self._finish_moving()
         return None
 
+    def move_um_sequence(self, zs, settle_s=0):
+        # absolute moves in order -> only 1 'ERR?' check for the sequence
+        self._finish_moving()
+        assert not self._analog_control
+        zs = np.asarray(zs, 'float64')
+        assert zs.ndim == 1, 'positions must be a 1D sequence'
+        if len(zs) == 0:
+            return None
+        assert zs.min() >= self.z_min, 'position out of range'
+        assert zs.max() <= self.z_max, 'position out of range'
+        if self.verbose:
+            print("%s: moving through %i positions (z)"%(self.name, len(zs)))
+        self._z_dirty = True # moving -> query controller until finished
+        for z in zs:
+            self.port.write(b'MOV 1 %0.9f\n'%z) # no 'ERR?' (checked at end)
+            self._start_move_timer(abs(z - self.z))
+            self.z = float(z)
+            self._wait_on_target()
+            if settle_s > 0: time.sleep(settle_s)
+        self._check_errors()
+        self._z_dirty = False # on target -> self.z is known
+        if self.verbose:
+            print("%s:  -> finished moving to %10.06f (um)"%(self.name, self.z))
+        return None
+
     def set_analog_control_limits(
         self, v_min=None, v_max=None, z_min_ai=None, z_max_ai=None):
         if self.verbose:
@@ -190,14 +327,16 @@ class Controller:
         # gain and offset from manual:
         self.gain = 0.1 * (z_max_ai - z_min_ai) / (v_max - v_min)
         self.offset = z_max_ai - self.gain * (10 * v_max)
-        self._send('SPA 2 0x02000300 %0.9f'%float(self.gain), respond=False)
-        self._send('SPA 2 0x02000200 %0.9f'%float(self.offset), respond=False)
+        # 1 write for both (the error code is kept until read by 'ERR?'):
+        self._send('SPA 2 0x02000300 %0.9f\nSPA 2 0x02000200 %0.9f'%(
+            float(self.gain), float(self.offset)), respond=False)
         if self.verbose:
             print("%s:  = (%5.03f, %5.03f)v and (%5.03f, %5.03f)um"%(
                 self.name, v_min, v_max, z_min_ai, z_max_ai))
         self.v_min, self.v_max = v_min, v_max
         self.z_min_ai, self.z_max_ai = z_min_ai, z_max_ai
         self._set_analogue_control_limits = True
+        self._last_ai_z = None # old gain and offset -> voltage no longer valid
         return None
 
     def get_voltage_for_move_um(self, z, relative=True):
@@ -212,22 +351,49 @@ class Controller:
         z_voltage = float(z - self.offset) / (self.gain * 10)
         if z_voltage < self.v_min: z_voltage = self.v_min # legalize edge cases
         if z_voltage > self.v_max: z_voltage = self.v_max
+        self._last_ai_z = self.offset + self.gain * (10 * z_voltage)
         if self.verbose:
             print("%s:  = %10.06f (v)"%(self.name, z_voltage))
         return z_voltage
 
-    def set_analog_control_enable(self, enable):
+    def get_voltages_for_move_um(self, zs, relative=False):
+        if self.verbose:
+            print("%s: voltages for move um (z_voltages)"%self.name)
+        assert self._set_analogue_control_limits, 'these must be set first'
+        zs = np.asarray(zs, 'float64')
+        assert zs.ndim == 1, 'positions must be a 1D sequence'
+        assert len(zs) > 0, 'no positions requested'
+        if relative: zs = self.z + zs
+        assert zs.min() >= self.z_min_ai - self.z_tol_um, 'position too low'
+        assert zs.max() <= self.z_max_ai + self.z_tol_um, 'position too high'
+        # same as .get_voltage_for_move_um() for an array of positions:
+        z_voltages = np.clip(
+            (zs - self.offset) / (self.gain * 10), self.v_min, self.v_max)
+        self._last_ai_z = self.offset + self.gain * (10 * float(z_voltages[-1]))
+        if self.verbose:
+            print("%s:  = %s (v)"%(self.name, z_voltages))
+        return z_voltages
+
+    def set_analog_control_enable(self, enable, use_last_voltage=False):
+        # 'use_last_voltage=True' -> caller applied the last voltage from
+        # .get_voltage(s)_for_move_um() so skip reading 'TSP? 2' when disabling
         if self.verbose:
             print("%s: setting analog control enable = %s"%(self.name, enable))
         assert self._set_analogue_control_limits, 'these must be set first'        
         if enable:
-            self._send('SPA 1 0x06000500 2', respond=False) # enable analog
-        if not enable: # read z from voltage on controller for current position
-            z_target = float(self._send('TSP? 2')[0].split('=')[1])
+            self._send(self._CMD_ANALOG_ON, respond=False) # enable analog
+            self._z_dirty = True # z now set by analog input
+        if not enable:
+            if use_last_voltage and self._last_ai_z is not None:
+                z_target = self._last_ai_z # no need to read from controller
+            else: # read z from voltage on controller for current position
+                z_target = self._parse_eq_float(
+                    self._send(self._CMD_TSP_2)[0])
             if z_target < self.z_min: z_target = self.z_min # legalize edges
             if z_target > self.z_max: z_target = self.z_max
-            self._send('SPA 1 0x06000500 0', respond=False) # disable analog
-            self._send('MOV 1 %0.9f'%z_target, respond=False) # zero movement
+            self._send(self._CMD_ANALOG_OFF, respond=False) # disable analog
+            self._send(b'MOV 1 %0.9f'%z_target, respond=False) # zero movement
+            self._last_ai_z = None # used -> get a new voltage for next time
             self.get_position(verbose=False) # update self.z after ao control
         self._analog_control = enable
         return None
@@ -258,6 +424,9 @@ if __name__ == '__main__':
     print(' do something else...')
     piezo.move_um(0, relative=False)
 
+    print('\nSequence of moves:')
+    piezo.move_um_sequence((10, 20, 30, 0))
+
     print('\nSwitch to analog control and back:')
     piezo.move_um(50, relative=False)               # move somewhere
     piezo.set_analog_control_limits(0, 10, 0, 100)  # configure analog
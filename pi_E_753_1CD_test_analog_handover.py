@@ -17,6 +17,7 @@ moves = np.linspace(z_min, z_max, num_moves)
 if random: moves = np.random.uniform(z_min, z_max, num_moves)
 
 # run:
+ao_volts = np.zeros((ao.s2p(ao_play_seconds), ao.num_channels), 'float64')
 print('\n Testing servo to analog control handover:')
 for move_um in moves:
     # servo move:
@@ -24,8 +25,7 @@ for move_um in moves:
     z_servo = piezo.get_position(verbose=False)
     # analog control:
     z_voltage = piezo.get_voltage_for_move_um(0)        # ~zero motion voltage
-    ao_volts = np.zeros((ao.s2p(ao_play_seconds), ao.num_channels), 'float64')
-    ao_volts[:, ao_piezo_channel - 1] = z_voltage       # make voltage array
+    ao_volts[:, ao_piezo_channel - 1] = z_voltage       # fill voltage array
     piezo.set_analog_control_enable(True)               # switch to analog
     ao.play_voltages(ao_volts, force_final_zeros=False) # play voltage
     z_analog = piezo.get_position(verbose=False)
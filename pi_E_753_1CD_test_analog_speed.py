@@ -17,32 +17,35 @@ piezo.set_analog_control_limits(0, 10, z_min, z_max) # -10 -> 10 = best control
 
 # run servo:
 print('Testing servo control speed:')
+piezo.move_um(moves[0], relative=False) # same start for both servo runs
 start = time.perf_counter()
 for move_um in moves:
     piezo.move_um(move_um, relative=False)
 servo_time_s = time.perf_counter() - start
-print('servo  time (s) = ', servo_time_s)
+print('servo  time (s) = ', servo_time_s, '(move_um)')
+piezo.move_um(moves[0], relative=False)
+start = time.perf_counter()
+piezo.move_um_sequence(moves) # 1 'ERR?' check for all moves
+servo_sequence_time_s = time.perf_counter() - start
+print('servo  time (s) = ', servo_sequence_time_s, '(move_um_sequence)')
 
 # run analog:
 print('Testing analog control speed:')
-voltages = []
-for move_um in moves:
-    z_voltage = piezo.get_voltage_for_move_um(move_um, relative=False)
-    ao_volts = np.zeros((ao.s2p(ao_play_seconds), ao.num_channels), 'float64')
-    ao_volts[:, ao_piezo_channel - 1] = z_voltage
-    voltages.append(ao_volts)
-voltages = np.concatenate(voltages, axis=0)
+nsamp = ao.s2p(ao_play_seconds)
+voltages = np.zeros((num_moves * nsamp, ao.num_channels), 'float64')
+z_voltages = piezo.get_voltages_for_move_um(moves, relative=False)
+voltages[:, ao_piezo_channel - 1] = np.repeat(z_voltages, nsamp)
 
 start = time.perf_counter()
 piezo.set_analog_control_enable(True)
 ao.play_voltages(voltages, force_final_zeros=False)
-piezo.set_analog_control_enable(False)
+piezo.set_analog_control_enable(False, use_last_voltage=True)
 analog_time_s = time.perf_counter() - start
 print('analog time (s) = ', analog_time_s)
 
 # difference:
 speed_up = servo_time_s / analog_time_s
-print('Analog speed up ~ %0.1fx'%speed_up)
+print('Analog speed up ~ %0.1fx (vs move_um)'%speed_up)
 
 # tidy up:
 piezo.move_um(0, relative=False)